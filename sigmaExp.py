@@ -1,10 +1,23 @@
 import os
+import re
+import sys
+import hashlib
+import json
 import subprocess
-import yaml
 import logging
+import multiprocessing
 import sqlite3
 import argparse
-from time import sleep
+import asyncio
+import queue
+import threading
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache, partial
+from itertools import islice
+from time import monotonic, time
+import httpx
 from dotenv import load_dotenv
 from sigma.collection import SigmaCollection
 from sigma.parser.collection import SigmaCollectionParser
@@ -34,170 +47,519 @@ SIGMA_RULES_PATH = "path/to/sigma/rules"
 SIGMA_RULES_GIT_URL = "https://github.com/SigmaHQ/sigma.git"
 DB_PATH = "uploaded_rules.db"
 EXPORT_DIR = "exported_queries"
+EXPORT_FILENAME = "exports.jsonl"
+CACHE_DIR = ".cache"
+CACHE_FORMAT = 3  # Bump whenever the cached ParsedRule fields change
+RATE_LIMIT_BURST = 10
+MAX_CONCURRENT_UPLOADS = 16
+HTTP_MAX_CONNECTIONS = 32
+DB_WRITE_BATCH_SIZE = 100
+RULE_SKIP, RULE_BACKFILL, RULE_PROCESS = 'skip', 'backfill', 'process'
+PARSE_CHUNK_SIZE = 32
+PARSE_QUEUE_SIZE = 128
+
+# Platforms CrowdStrike accepts for custom IOA rule groups
+CROWDSTRIKE_PLATFORMS = {'windows', 'mac', 'linux'}
+
+# Backend classes keyed by --backend name; instantiated inside each parser process
+BACKENDS = {
+    'crowdstrike': CrowdStrikeBackend,
+    'rapid7': InsightIDRBackend,  # Replace with actual Rapid7 backend if available
+}
+
+# The parts of a parsed Sigma rule the exporters use; plain data so it can be cached as JSON
+ParsedRule = namedtuple('ParsedRule', ['id', 'title', 'query', 'platform', 'rule_content', 'content_sha'])
 
 # Clone or update the Sigma rules repository
 def clone_or_update_sigma_repo(repo_url, repo_path):
+    # Only the checked-out tree is read, so skip history, tags and other branches
     if not os.path.exists(repo_path):
-        subprocess.run(["git", "clone", repo_url, repo_path], check=True)
+        subprocess.run(["git", "clone", "--filter=blob:none", "--depth=1", "--single-branch", "--no-tags",
+                        repo_url, repo_path], check=True)
     else:
-        subprocess.run(["git", "-C", repo_path, "pull"], check=True)
+        subprocess.run(["git", "-C", repo_path, "fetch", "--depth=1", "--filter=blob:none", "origin", "HEAD"],
+                       check=True)
+        subprocess.run(["git", "-C", repo_path, "reset", "--hard", "FETCH_HEAD"], check=True)
 
 # Function to load Sigma rules from the cloned repository
 def load_sigma_rules(path):
     rules = []
-    for root, _, files in os.walk(path):
-        for file in files:
-            if file.endswith(".yml"):
-                full_path = os.path.join(root, file)
-                platform = determine_platform(full_path)
-                rules.append((full_path, platform))
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        # Rules are organised by platform directory, so classify once per directory
+        platform = determine_platform(directory)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".yml"):
+                    with open(entry.path, 'rb') as rule_file:
+                        content_sha = hashlib.sha256(rule_file.read()).digest()
+                    rules.append((entry.path, platform, content_sha))
     return rules
 
-# Function to determine platform based on file path
-def determine_platform(file_path):
-    if "windows" in file_path.lower():
-        return "windows"
-    elif "linux" in file_path.lower():
-        return "linux"
-    elif "macos" in file_path.lower():
-        return "mac"
-    else:
-        return "unknown"
+# Platform directory names in the Sigma repository, and the platform names we use where they differ
+_PLATFORM_RE = re.compile(r'/(windows|linux|macos)/')
+_PLATFORM_MAP = {'macos': 'mac'}
+
+# Function to determine platform based on a rule's directory
+@lru_cache(maxsize=None)
+def determine_platform(dir_path):
+    match = _PLATFORM_RE.search(f"/{dir_path.lower().replace(os.sep, '/')}/")
+    return _PLATFORM_MAP.get(match.group(1), match.group(1)) if match else 'unknown'
 
 # Initialize SQLite database
 def init_db(db_path):
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS uploaded_rules (
             id TEXT PRIMARY KEY,
             title TEXT,
-            rule_content TEXT,
-            backend TEXT
+            rule_content BLOB,
+            backend TEXT,
+            content_sha BLOB
         )
     ''')
+    # Databases created before content hashing lack the content_sha column
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(uploaded_rules)")]
+    if 'content_sha' not in columns:
+        cursor.execute("ALTER TABLE uploaded_rules ADD COLUMN content_sha BLOB")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_uploaded_rules_backend_id ON uploaded_rules (backend, id)")
     conn.commit()
     return conn
 
-# Check if rule exists in the database
-def rule_exists_in_db(cursor, rule_id, backend):
-    cursor.execute("SELECT 1 FROM uploaded_rules WHERE id = ? AND backend = ?", (rule_id, backend))
-    return cursor.fetchone() is not None
-
-# Get rule content from the database
-def get_rule_content_from_db(cursor, rule_id, backend):
-    cursor.execute("SELECT rule_content FROM uploaded_rules WHERE id = ? AND backend = ?", (rule_id, backend))
-    row = cursor.fetchone()
-    return row[0] if row else None
-
-# Save rule to the database
-def save_rule_to_db(cursor, rule_id, rule_title, rule_content, backend):
-    cursor.execute("REPLACE INTO uploaded_rules (id, title, rule_content, backend) VALUES (?, ?, ?, ?)",
-                   (rule_id, rule_title, rule_content, backend))
-
-# Parse and convert Sigma rules to backend queries
-def parse_and_convert_rules(sigma_rules, backend):
-    collection = SigmaCollection()
-    parser = SigmaCollectionParser(collection, None, backend)
-    parsed_rules = []
-    for file_path, platform in sigma_rules:
-        with open(file_path, 'r') as rule_file:
-            rule_content = rule_file.read()
-        parsed_rule = parser.parse(rule_content)
-        parsed_rules.append((parsed_rule, platform))
-    return parsed_rules
-
-# Create rule group if it doesn't exist and return its ID (CrowdStrike specific)
+# Load the stored (content_sha, rule_content) of every rule already processed for a backend
+def load_existing_rules(cursor, backend):
+    cursor.execute("SELECT id, content_sha, rule_content FROM uploaded_rules WHERE backend = ?", (backend,))
+    return {rule_id: (content_sha, rule_content) for rule_id, content_sha, rule_content in cursor}
+
+# Save a batch of (id, title, rule_content, backend, content_sha) rows in one transaction
+def save_rules_to_db(cursor, rows):
+    if not rows:
+        return
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    cursor.executemany("REPLACE INTO uploaded_rules (id, title, rule_content, backend, content_sha) VALUES (?, ?, ?, ?, ?)",
+                       rows)
+    cursor.connection.commit()
+
+# Decide whether a parsed rule needs processing, given its stored (content_sha, rule_content) if any
+# Rows from before content hashing have no hash and a YAML rule_content that can't be compared with the fingerprint;
+# legacy_up_to_date says whether to take them as already processed or to process them again
+def check_existing_rule(stored, rule_name, rule_content, content_sha, legacy_up_to_date):
+    if stored is None:
+        return RULE_PROCESS
+    existing_sha, existing_content = stored
+    # Source YAML is byte-identical to what was last processed
+    if existing_sha == content_sha:
+        logging.info(f"Rule {rule_name} already exists and is up to date.")
+        return RULE_SKIP
+    if existing_content == rule_content:
+        logging.info(f"Rule {rule_name} is unchanged, backfilling its content hash.")
+        return RULE_BACKFILL
+    if existing_sha is None and legacy_up_to_date:
+        logging.info(f"Rule {rule_name} predates content hashing, backfilling it as up to date.")
+        return RULE_BACKFILL
+    return RULE_PROCESS
+
+# Queue a rule for saving, flushing once DB_WRITE_BATCH_SIZE rows are pending
+def queue_rule_for_db(cursor, pending_writes, rule_id, rule_title, rule_content, content_sha, backend):
+    pending_writes.append((rule_id, rule_title, rule_content, backend, content_sha))
+    if len(pending_writes) >= DB_WRITE_BATCH_SIZE:
+        save_rules_to_db(cursor, pending_writes)
+        pending_writes.clear()
+
+# Parsers built so far in this process, keyed by backend name
+_parsers = {}
+
+# Get or lazily build the parser for a backend (backends don't pickle, so each worker builds its own)
+def _get_parser(backend_name):
+    parser = _parsers.get(backend_name)
+    if parser is None:
+        collection = SigmaCollection()
+        parser = SigmaCollectionParser(collection, None, BACKENDS[backend_name]())
+        _parsers[backend_name] = parser
+    return parser
+
+# Compact fingerprint of the exported fields, stored as rule_content to detect changed rules
+def rule_fingerprint(rule_id, title, query):
+    canonical = json.dumps({'id': rule_id, 'title': title, 'query': query}, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).digest()
+
+# Parse a single Sigma rule file (runs in a worker process)
+def _parse_one(args):
+    file_path, platform, content_sha, backend_name = args
+    # Hand the parser the binary stream so PyYAML reads it through its own buffer
+    with open(file_path, 'rb') as rule_file:
+        parsed_rule = _get_parser(backend_name).parse(rule_file)
+    rule_content = rule_fingerprint(parsed_rule.id, parsed_rule.title, parsed_rule.queries[0])
+    return ParsedRule(parsed_rule.id, parsed_rule.title, parsed_rule.queries[0], platform, rule_content, content_sha)
+
+# Parse a chunk of rule files in one worker round-trip
+def _parse_chunk(jobs):
+    return [_parse_one(job) for job in jobs]
+
+# Parser workers are started from a clean server process: the pool is driven from a background
+# thread, and forking a multi-threaded process is unsafe
+_PARSE_MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Parse and convert Sigma rules to backend queries across all CPU cores, yielding rules as chunks finish.
+# At most 2 chunks per worker are outstanding, so parsing runs only as far ahead as the consumer allows.
+def parse_and_convert_rules(sigma_rules, backend_name):
+    jobs = ((file_path, platform, content_sha, backend_name) for file_path, platform, content_sha in sigma_rules)
+    chunks = batched(jobs, PARSE_CHUNK_SIZE)
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_PARSE_MP_CONTEXT) as executor:
+        pending = {executor.submit(_parse_chunk, chunk) for chunk in islice(chunks, 2 * workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                # Drop each future as it is consumed so its results can be freed
+                future = done.pop()
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    pending.add(executor.submit(_parse_chunk, next_chunk))
+                for rule in future.result():
+                    yield rule
+                del future
+
+# Get the commit checked out in a git repository
+def get_repo_head(repo_path):
+    return subprocess.check_output(["git", "-C", repo_path, "rev-parse", "HEAD"], text=True).strip()
+
+# Yield parsed rules from the cache for the current Sigma commit, parsing and caching them on a miss
+def load_or_parse_rules(repo_path, backend_name):
+    head = get_repo_head(repo_path)
+    cache_path = os.path.join(CACHE_DIR, f"parsed_{backend_name}_{head}_v{CACHE_FORMAT}.jsonl")
+    if os.path.exists(cache_path):
+        logging.info(f"Loading parsed rules from {cache_path}")
+        # One JSON object per line, read lazily so a warm run never holds the whole cache
+        with open(cache_path, 'r') as cache_file:
+            for line in cache_file:
+                entry = json.loads(line)
+                # Every line decodes to fresh strings; share the handful of platform names
+                yield ParsedRule(**{**entry, 'platform': sys.intern(entry['platform']),
+                                    'rule_content': bytes.fromhex(entry['rule_content']),
+                                    'content_sha': bytes.fromhex(entry['content_sha'])})
+        return
+
+    # Caches for older commits or formats can never be hit again
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith(f"parsed_{backend_name}_") and entry.path != cache_path:
+            os.remove(entry.path)
+
+    # Stream entries into a temporary file, only moving it into place once every rule has been written
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, 'w') as cache_file:
+            for rule in parse_and_convert_rules(load_sigma_rules(repo_path), backend_name):
+                entry = {**rule._asdict(), 'rule_content': rule.rule_content.hex(), 'content_sha': rule.content_sha.hex()}
+                cache_file.write(json.dumps(entry) + "\n")
+                yield rule
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Run a producer generator in a background thread, handing its items over through a bounded queue
+def stream_in_background(iterable, maxsize=PARSE_QUEUE_SIZE):
+    items = queue.Queue(maxsize=maxsize)
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(None)  # Sentinel: the producer is done
+
+    threading.Thread(target=produce, daemon=True).start()
+    while (item := items.get()) is not None:
+        yield item
+    if errors:
+        raise errors[0]
+
+# Token bucket pacing API calls; the rate backs off on throttling and recovers on success (AIMD)
+class TokenBucket:
+    def __init__(self, rate_per_min, burst):
+        self.max_rate = rate_per_min
+        self.rate = rate_per_min
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = monotonic()
+        self.resume_at = 0  # No request may start before this monotonic time
+        self.last_backoff = 0  # When the rate was last halved
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate / 60)
+        self.last_refill = now
+
+    # Wait until any server-imposed pause is over and a token is available, then take it;
+    # returns the time the request was let through, for backoff()
+    async def acquire(self):
+        while True:
+            # Only the bookkeeping is locked; waiters sleep outside it and re-check on waking
+            async with self.lock:
+                now = monotonic()
+                if now < self.resume_at:
+                    delay = self.resume_at - now
+                else:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now
+                    delay = (1 - self.tokens) * 60 / self.rate
+            await asyncio.sleep(delay)
+
+    # Hold off all requests for the server-imposed delay; overlapping pauses share one window
+    def pause(self, seconds):
+        self.resume_at = max(self.resume_at, monotonic() + seconds)
+        self.tokens = 0
+        self.last_refill = self.resume_at
+
+    # Throttled by the server: pause, and halve the rate unless a request issued
+    # after this one has already done so (one halving per throttling window)
+    def backoff(self, seconds, requested_at):
+        if requested_at >= self.last_backoff:
+            self.rate = max(self.rate / 2, 1)
+            self.last_backoff = monotonic()
+        self.pause(seconds)
+
+    # Request went through: grow the rate back towards the configured maximum
+    def recover(self):
+        self.rate = min(self.rate + 1, self.max_rate)
+
+# Seconds the API asked us to wait before the next request
+def retry_after_seconds(headers):
+    if 'Retry-After' in headers:
+        retry_after = headers['Retry-After']
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        # Retry-After may also be an HTTP-date
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time(), 0)
+        except (TypeError, ValueError):
+            return 1
+    if 'X-RateLimit-RetryAfter' in headers:
+        # CrowdStrike reports the epoch time at which the quota resets
+        return max(float(headers['X-RateLimit-RetryAfter']) - time(), 0)
+    return 1
+
+# Create rule group if it doesn't exist and return its ID, or None if it can't be created (CrowdStrike specific)
 def create_or_get_rule_group_crowdstrike(custom_ioa, platform, rule_group_name):
+    # Reuse the group an earlier run created
+    response = custom_ioa.query_rule_groups(filter=f"name:'{rule_group_name}'+platform:'{platform}'", limit=1)
+    existing_ids = response['body'].get('resources') or []
+    if existing_ids:
+        return existing_ids[0]
+
     response = custom_ioa.create_rule_group(
         platform_name=platform,
         name=rule_group_name,
         description="Custom IOA rule group created from Sigma rules",
         comments="Automatically generated"
     )
-    return response['resources'][0]['id']
-
-# Process and upload Sigma rules to CrowdStrike
-def process_rules_crowdstrike(parsed_rules, custom_ioa, cursor, test_mode):
-    created_rule_groups = {}
-    for parsed_rule, platform in parsed_rules:
-        rule_id = parsed_rule.id
-        rule_name = parsed_rule.title
-        rule_content = yaml.dump(parsed_rule)
-        cs_query = parsed_rule.queries[0]
-
-        if rule_exists_in_db(cursor, rule_id, 'crowdstrike'):
-            existing_content = get_rule_content_from_db(cursor, rule_id, 'crowdstrike')
-            if existing_content == rule_content:
-                logging.info(f"Rule {rule_name} already exists and is up to date.")
-                continue
-
-        rule_group_name = f"Sigma Rule Group - {rule_name} ({platform})"
-        if rule_group_name not in created_rule_groups:
-            rule_group_id = create_or_get_rule_group_crowdstrike(custom_ioa, platform, rule_group_name)
-            created_rule_groups[rule_group_name] = rule_group_id
-        else:
-            rule_group_id = created_rule_groups[rule_group_name]
-
-        # Adjust parameters for test mode
-        pattern_severity = 2 if not test_mode else 1
-        pattern_disposition = 100 if not test_mode else 200
-
-        # Create the IOA rule
-        response = custom_ioa.create_rule(
-            name=f"Sigma Rule - {rule_name}",
-            description=f"Converted Sigma rule: {rule_name}",
-            rule_group_id=rule_group_id,
-            pattern_severity=pattern_severity,  # Set severity
-            pattern_disposition=pattern_disposition,  # Set disposition
-            field_values=[
-                {"field": "CommandLine", "type": "string", "value": cs_query}
-            ]
-        )
-        if response['meta']['rc'] == 'SUCCESS':
-            logging.info(f"Successfully created rule: {rule_name}")
-            save_rule_to_db(cursor, rule_id, rule_name, rule_content, 'crowdstrike')
-        else:
-            logging.error(f"Failed to create rule: {rule_name}, Error: {response}")
-
-        sleep(1)  # Add a short delay to handle rate limiting
+    resources = response['body'].get('resources') or []
+    if not resources:
+        logging.error(f"Failed to create rule group: {rule_group_name}, Error: {response['body'].get('errors')}")
+        return None
+    return resources[0]['id']
+
+# argparse type for --rate-per-minute: the token bucket needs a positive rate
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+# Split an iterable into lists of at most size items
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+# Fetch an OAuth2 bearer token for direct CrowdStrike API calls
+def get_bearer_token(oauth2):
+    response = oauth2.token()
+    return response['body']['access_token']
+
+# Swap in a fresh bearer token unless another upload has already done so
+async def refresh_bearer_token(client, oauth2, auth_lock, stale_authorization):
+    # One refresh at a time; uploads that queued behind it see the new header and skip theirs
+    async with auth_lock:
+        if client.headers.get("Authorization") == stale_authorization:
+            logging.info("CrowdStrike bearer token expired, re-authenticating")
+            token = await asyncio.to_thread(get_bearer_token, oauth2)
+            client.headers["Authorization"] = f"Bearer {token}"
+
+# Create a single IOA rule, retrying while the API throttles us
+async def create_rule_crowdstrike(client, oauth2, auth_lock, bucket, rule_group_id, rule_name, cs_query, test_mode):
+    # Adjust parameters for test mode
+    pattern_severity = 2 if not test_mode else 1
+    pattern_disposition = 100 if not test_mode else 200
+
+    payload = {
+        "name": f"Sigma Rule - {rule_name}",
+        "description": f"Converted Sigma rule: {rule_name}",
+        "rulegroup_id": rule_group_id,
+        "pattern_severity": pattern_severity,  # Set severity
+        "disposition_id": pattern_disposition,  # Set disposition
+        "field_values": [
+            {"field": "CommandLine", "type": "string", "value": cs_query}
+        ]
+    }
+    reauthenticated = False
+    while True:
+        requested_at = await bucket.acquire()
+        response = await client.post("/ioarules/entities/rules/v1", json=payload)
+        headers = response.headers
+        if response.status_code == 401 and not reauthenticated:
+            await refresh_bearer_token(client, oauth2, auth_lock, response.request.headers.get("Authorization"))
+            reauthenticated = True
+            continue
+        if response.status_code == 429:
+            retry_after = retry_after_seconds(headers)
+            logging.warning(f"Rate limited while creating rule {rule_name}, retrying in {retry_after:.1f}s")
+            bucket.backoff(retry_after, requested_at)
+            continue
+        bucket.recover()
+        if int(headers.get('X-RateLimit-Remaining', 1)) == 0:
+            bucket.pause(retry_after_seconds(headers))
+        body = response.json() if response.content else {}
+        return response.status_code, body
+
+# Queue a finished upload's rule for the database if CrowdStrike accepted it
+def record_upload_crowdstrike(cursor, pending_writes, rule, upload):
+    rule_id, rule_name, rule_content, content_sha = rule
+    if upload.cancelled():
+        logging.error(f"Failed to create rule: {rule_name}, Error: upload cancelled")
+        return
+    if upload.exception() is not None:
+        logging.error(f"Failed to create rule: {rule_name}, Error: {upload.exception()}")
+        return
+    status, body = upload.result()
+    if status < 300 and not body.get('errors'):
+        logging.info(f"Successfully created rule: {rule_name}")
+        queue_rule_for_db(cursor, pending_writes, rule_id, rule_name, rule_content, content_sha, 'crowdstrike')
+    else:
+        logging.error(f"Failed to create rule: {rule_name}, Error: {body}")
+
+# Process and upload Sigma rules to CrowdStrike as they arrive from the parser
+async def process_rules_crowdstrike(parsed_rules, custom_ioa, oauth2, cursor, test_mode, rate_per_minute):
+    bucket = TokenBucket(rate_per_minute, RATE_LIMIT_BURST)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    auth_lock = asyncio.Lock()
+    existing = load_existing_rules(cursor, 'crowdstrike')
+    pending_writes = []
+    groups = {}
+    in_flight = set()
+
+    # Each upload is recorded as soon as it is answered, freeing its slot for the next rule
+    def finish_upload(rule, upload):
+        in_flight.discard(upload)
+        semaphore.release()
+        record_upload_crowdstrike(cursor, pending_writes, rule, upload)
+
+    # Upload over one pooled HTTP/2 client, with up to MAX_CONCURRENT_UPLOADS requests in flight
+    headers = {"Authorization": f"Bearer {get_bearer_token(oauth2)}"}
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+    async with httpx.AsyncClient(base_url=CROWDSTRIKE_BASE_URL, http2=True, timeout=30, limits=limits,
+                                 headers=headers) as client:
+        try:
+            # Pull rules off the thread so a slow parser doesn't stall uploads already in flight
+            rules = iter(parsed_rules)
+            while (rule := await asyncio.to_thread(next, rules, None)) is not None:
+                rule_id, rule_name, cs_query, platform, rule_content, content_sha = rule
+
+                # Re-uploading would duplicate rules already in CrowdStrike, so legacy rows are taken as up to date
+                action = check_existing_rule(existing.get(rule_id), rule_name, rule_content, content_sha, True)
+                if action == RULE_BACKFILL:
+                    # Record the hash and fingerprint so the next run can skip this rule early
+                    queue_rule_for_db(cursor, pending_writes, rule_id, rule_name, rule_content, content_sha,
+                                      'crowdstrike')
+                if action != RULE_PROCESS:
+                    continue
+
+                if platform not in CROWDSTRIKE_PLATFORMS:
+                    logging.warning(f"Skipping rule {rule_name}: platform '{platform}' is not supported by CrowdStrike")
+                    continue
+
+                # One rule group per platform, looked up or created the first time that platform needs one
+                if platform not in groups:
+                    groups[platform] = await asyncio.to_thread(create_or_get_rule_group_crowdstrike, custom_ioa,
+                                                               platform, f"Sigma Rule Group - {platform}")
+                if groups[platform] is None:
+                    logging.error(f"Skipping rule {rule_name}: no rule group for platform {platform}")
+                    continue
+
+                # Taking the slot before pulling the next rule also holds back the parser when uploads are full
+                await semaphore.acquire()
+                upload = asyncio.create_task(create_rule_crowdstrike(client, oauth2, auth_lock, bucket,
+                                                                     groups[platform], rule_name, cs_query,
+                                                                     test_mode))
+                in_flight.add(upload)
+                upload.add_done_callback(partial(finish_upload, (rule_id, rule_name, rule_content, content_sha)))
+        finally:
+            # Uploads already sent may have created rules, so wait for them even if the run is failing
+            try:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            finally:
+                save_rules_to_db(cursor, pending_writes)
 
 # Process and export Sigma rules to Rapid7 InsightIDR
+# Queries are appended to a single JSON Lines file; a later line for a rule supersedes earlier ones
 def process_rules_rapid7(parsed_rules, cursor, test_mode, export_dir):
-    if not os.path.exists(export_dir):
-        os.makedirs(export_dir)
-
-    for parsed_rule, platform in parsed_rules:
-        rule_id = parsed_rule.id
-        rule_name = parsed_rule.title
-        rule_content = yaml.dump(parsed_rule)
-        r7_query = parsed_rule.queries[0]
-
-        if rule_exists_in_db(cursor, rule_id, 'rapid7'):
-            existing_content = get_rule_content_from_db(cursor, rule_id, 'rapid7')
-            if existing_content == rule_content:
-                logging.info(f"Rule {rule_name} already exists and is up to date.")
-                continue
-
-        # Export the query to a file
-        query_filename = os.path.join(export_dir, f"{rule_name}.txt")
-        with open(query_filename, 'w') as query_file:
-            query_file.write(r7_query)
-
-        logging.info(f"Exported rule {rule_name} to {query_filename}")
-        save_rule_to_db(cursor, rule_id, rule_name, rule_content, 'rapid7')
+    export_path = os.path.join(export_dir, EXPORT_FILENAME)
+    existing = load_existing_rules(cursor, 'rapid7')
+    pending_writes = []
+    try:
+        with open(export_path, 'a', buffering=1 << 16) as export_file:
+            for rule_id, rule_name, r7_query, platform, rule_content, content_sha in parsed_rules:
+                # Legacy rows predate the single export file, so export them again rather than leave them out of it
+                action = check_existing_rule(existing.get(rule_id), rule_name, rule_content, content_sha, False)
+                if action == RULE_BACKFILL:
+                    # Record the hash and fingerprint so the next run can skip this rule early
+                    queue_rule_for_db(cursor, pending_writes, rule_id, rule_name, rule_content, content_sha,
+                                      'rapid7')
+                if action != RULE_PROCESS:
+                    continue
+
+                # Export the query
+                export_file.write(json.dumps({"rule": rule_name, "platform": platform, "query": r7_query}) + "\n")
+
+                logging.info(f"Exported rule {rule_name} to {export_path}")
+                queue_rule_for_db(cursor, pending_writes, rule_id, rule_name, rule_content, content_sha, 'rapid7')
+    finally:
+        # Save what was exported even if the run is failing
+        save_rules_to_db(cursor, pending_writes)
 
 def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Process Sigma rules and upload to CrowdStrike or export to Rapid7.")
     parser.add_argument('--test', action='store_true', help="Run in test mode")
     parser.add_argument('--backend', choices=['crowdstrike', 'rapid7'], required=True, help="Choose the backend to use: 'crowdstrike' or 'rapid7'")
+    parser.add_argument('--rate-per-minute', type=positive_int, default=60, help="Maximum CrowdStrike API calls per minute")
     args = parser.parse_args()
 
     print("Welcome to the Sigma Rule Processor!")
     print("You can use the following arguments:")
     print("  --test: Run in test mode")
     print("  --backend: Choose the backend to use: 'crowdstrike' or 'rapid7'")
+    print("  --rate-per-minute: Maximum CrowdStrike API calls per minute (default: 60)")
     print("\nNote: For Rapid7, this script will only create and export search queries.")
 
     # Initialize the database
@@ -206,15 +568,14 @@ def main():
 
     try:
         clone_or_update_sigma_repo(SIGMA_RULES_GIT_URL, SIGMA_RULES_PATH)
-        sigma_rules = load_sigma_rules(SIGMA_RULES_PATH)
 
         if args.backend == 'crowdstrike':
-            backend = CrowdStrikeBackend()
-            parsed_rules = parse_and_convert_rules(sigma_rules, backend)
-            process_rules_crowdstrike(parsed_rules, custom_ioa, cursor, args.test)
+            parsed_rules = stream_in_background(load_or_parse_rules(SIGMA_RULES_PATH, 'crowdstrike'))
+            asyncio.run(process_rules_crowdstrike(parsed_rules, custom_ioa, oauth2, cursor, args.test,
+                                                  args.rate_per_minute))
         elif args.backend == 'rapid7':
-            backend = InsightIDRBackend()  # Replace with actual Rapid7 backend if available
-            parsed_rules = parse_and_convert_rules(sigma_rules, backend)
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            parsed_rules = stream_in_background(load_or_parse_rules(SIGMA_RULES_PATH, 'rapid7'))
             process_rules_rapid7(parsed_rules, cursor, args.test, EXPORT_DIR)
 
     except Exception as e: